@@ -1,29 +1,58 @@
 import fastapi
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import jpholiday
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import pytz
 import logging
+import re
 import json
+import orjson
 import asyncio
-import requests_cache
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from functools import lru_cache, partial
 
-from fx_bot import router as fx_router, start_scheduler, stop_scheduler
+from fx_bot import router as fx_router, start_scheduler, stop_scheduler, open_line_client, close_line_client
 
+# Japan Standard Time, used for the 15:30 cutoff and the JPX cache key
+JST = pytz.timezone('Asia/Tokyo')
+
+# Shared async HTTP/2 client for outbound HTTP (JPX); keep-alive connections are reused across requests.
+# Created in lifespan, because a closed client cannot be reopened and each lifespan may run on a new event loop
+HTTP_CLIENT = None
+
+# Dedicated pool for blocking yfinance calls so concurrent proxy requests overlap their network waits.
+# Also per lifespan: the pool is shut down on exit, and the lock must belong to the running loop
+YF_EXECUTOR = None
+YF_DOWNLOAD_LOCK = None
 
 @asynccontextmanager
 async def lifespan(app):
     """起動時にFXスケジューラーを開始し、終了時に停止する"""
+    global HTTP_CLIENT, YF_EXECUTOR, YF_DOWNLOAD_LOCK
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=10.0,
+        follow_redirects=True,
+        transport=httpx.AsyncHTTPTransport(http2=True, retries=3, limits=httpx.Limits(max_keepalive_connections=32)),
+    )
+    YF_EXECUTOR = ThreadPoolExecutor(max_workers=12, thread_name_prefix="yfinance")
+    YF_DOWNLOAD_LOCK = asyncio.Lock()
+    open_line_client()
     start_scheduler()
     yield
     stop_scheduler()
+    YF_EXECUTOR.shutdown(wait=False)
+    YF_EXECUTOR = None
+    await HTTP_CLIENT.aclose()
+    HTTP_CLIENT = None
+    await close_line_client()
 
 app = fastapi.FastAPI(title="ETF Viewer", lifespan=lifespan)
 
@@ -38,21 +67,29 @@ async def get_index():
         return HTMLResponse(content=f.read())
 
 
+# Mon-Fri business-day calendar with Japanese public holidays, covering the ~14 months of history the ETF view looks back over
+_this_year = datetime.now().year
+JP_BUSDAY_CALENDAR = np.busdaycalendar(
+    weekmask='1111100',
+    holidays=[d for y in range(_this_year - 3, _this_year + 2) for d, _ in jpholiday.year_holidays(y)],
+)
+
+@lru_cache(maxsize=8)
+def _business_days(end_day: date, count: int) -> tuple:
+    """Cached core of get_business_days_list, keyed on the calendar day so it is computed at most once per target date"""
+    # Roll back to the latest business day, then step back over weekends and Japanese holidays in one vectorized call
+    offsets = np.busday_offset(np.datetime64(end_day), -np.arange(count), roll='backward', busdaycal=JP_BUSDAY_CALENDAR)
+    return tuple(offsets.astype(object))
+
 def get_business_days_list(end_date: datetime, count: int) -> list:
     """Returns a list of `count` past Japanese business days up to `end_date`"""
-    days = []
-    current_date = end_date
-    while len(days) < count:
-        # Check if it's a weekend or Japanese holiday
-        if current_date.weekday() < 5 and not jpholiday.is_holiday(current_date.date()):
-            days.append(current_date)
-        current_date -= timedelta(days=1)
-    return days
-
-def get_business_dates_info():
+    end_day = end_date.date()
+    return [end_date - timedelta(days=(end_day - d).days) for d in _business_days(end_day, count)]
+
+def get_business_dates_info(now: datetime = None):
     """Calculates the target evaluation dates for the ETF data based on the 15:30 JST rule."""
-    jst = pytz.timezone('Asia/Tokyo')
-    now = datetime.now(jst)
+    if now is None:
+        now = datetime.now(JST)
     
     target_date = now
     if now.hour < 15 or (now.hour == 15 and now.minute < 30):
@@ -65,43 +102,38 @@ def get_business_dates_info():
         "target_str": recent_b_days[0].strftime('%Y-%m-%d')
     }
 
-@app.get("/api/fetch_etfs", response_class=JSONResponse)
-async def fetch_etfs():
-    """
-    Scrapes JPX ETF page and returns the list of ETFs.
-    Does NOT fetch Yahoo Finance data (left to the client).
-    """
-    logger = logging.getLogger("uvicorn.error")
-    
-    url = "https://www.jpx.co.jp/equities/products/etfs/issues/01.html"
-    try:
-        response = await asyncio.to_thread(requests.get, url, timeout=10)
-        response.raise_for_status()
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": f"Failed to fetch JPX page: {str(e)}"})
-        
-    soup = BeautifulSoup(response.content, 'html.parser')
+# Everything str.isalnum() rejects: non-word characters plus the underscore
+_NON_ALNUM = re.compile(r'[\W_]+')
+
+def parse_jpx_etfs(content: bytes):
+    """Parses the JPX ETF issues page into a list of ETF dicts. Returns None if the ETF table is missing."""
+    # lxml parses in C, and only <table> subtrees are built into the soup
+    soup = BeautifulSoup(content, 'lxml', parse_only=SoupStrainer('table'))
     
     table = soup.find('table')
     if not table:
-         return JSONResponse(status_code=500, content={"error": "Could not find the ETF table on the JPX page."})
+        return None
          
     tbody = table.find('tbody')
     rows = tbody.find_all('tr') if tbody else table.find_all('tr')
     
-    valid_rows = [r for r in rows if len(r.find_all(['td', 'th'])) >= 5 and r.find_all(['td', 'th'])[0].name != 'th']
+    # Scan each row's cells once and keep them for the extraction loop below
+    valid_rows = []
+    for r in rows:
+        cells = r.find_all(['td', 'th'])
+        if len(cells) >= 5 and cells[0].name != 'th':
+            valid_rows.append(cells)
     
     etf_list = []
     
-    for row in valid_rows:
-        tds = row.find_all(['td', 'th'])
+    for tds in valid_rows:
         benchmark = tds[0].get_text(strip=True)
         code_text = tds[1].get_text(strip=True)
         name = tds[2].get_text(strip=True)
         management = tds[3].get_text(strip=True)
         fee = tds[4].get_text(strip=True)
         
-        code_match = ''.join(filter(str.isalnum, code_text))
+        code_match = _NON_ALNUM.sub('', code_text)
         
         if code_match:
             etf_list.append({
@@ -113,9 +145,70 @@ async def fetch_etfs():
                 "fee": fee
             })
 
-    dates = get_business_dates_info()
+    return etf_list
+
+# Parsed JPX ETF list keyed on the JST date: {date: (fetched_at, etf_list)}.
+# The issues page changes at most once a day, so it is re-scraped only when the day rolls over or the TTL expires.
+JPX_CACHE_TTL = timedelta(hours=6)
+_JPX_CACHE = {}
+
+@app.get("/api/fetch_etfs", response_class=JSONResponse)
+async def fetch_etfs():
+    """
+    Scrapes JPX ETF page and returns the list of ETFs.
+    Does NOT fetch Yahoo Finance data (left to the client).
+    """
+    logger = logging.getLogger("uvicorn.error")
+    
+    now = datetime.now(JST)
+    cached = _JPX_CACHE.get(now.date())
+    if cached is not None and now - cached[0] < JPX_CACHE_TTL:
+        etf_list = cached[1]
+    else:
+        url = "https://www.jpx.co.jp/equities/products/etfs/issues/01.html"
+        try:
+            response = await HTTP_CLIENT.get(url)
+            response.raise_for_status()
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": f"Failed to fetch JPX page: {str(e)}"})
+            
+        etf_list = parse_jpx_etfs(response.content)
+        if etf_list is None:
+            return JSONResponse(status_code=500, content={"error": "Could not find the ETF table on the JPX page."})
+
+        _JPX_CACHE.clear()
+        _JPX_CACHE[now.date()] = (now, etf_list)
+
+    dates = get_business_dates_info(now)
     return {"status": "success", "data": etf_list, "target_date": dates['target_str']}
 
+# yf.Ticker instances reused across proxy requests. The symbol comes straight from the
+# public path parameter, so the cache is a bounded LRU rather than a dict that grows per symbol.
+TICKER_CACHE_MAXSIZE = 256
+
+@lru_cache(maxsize=TICKER_CACHE_MAXSIZE)
+def _cached_ticker(symbol: str) -> yf.Ticker:
+    return yf.Ticker(symbol)
+
+def get_ticker(symbol: str) -> yf.Ticker:
+    """Returns the cached yf.Ticker for `symbol` (normalised so '1306.t' and '1306.T' share an entry)"""
+    return _cached_ticker(symbol.strip().upper())
+
+def orjson_response(content) -> Response:
+    """Serializes large history payloads with orjson instead of FastAPI's pure-Python JSON encoding"""
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
+def history_to_dict(hist: pd.DataFrame) -> dict:
+    """Converts a yfinance history frame to {date_str: {"Close", "Dividends"}} for JSON"""
+    dividends = hist['Dividends'].fillna(0.0).to_numpy(dtype=float) if 'Dividends' in hist else 0.0
+    out = pd.DataFrame(
+        {"Close": hist['Close'].to_numpy(dtype=float), "Dividends": dividends},
+        index=hist.index.strftime('%Y-%m-%d'),
+    )
+    # Later rows win on a repeated date, as they did when the dict was filled row by row
+    out = out[~out.index.duplicated(keep='last')]
+    return out.to_dict(orient='index')
+
 @app.get("/api/proxy/yfinance/{ticker}", response_class=JSONResponse)
 async def proxy_yfinance(ticker: str):
     """
@@ -126,30 +219,80 @@ async def proxy_yfinance(ticker: str):
         end_date = datetime.now() + timedelta(days=1)
         start_date = end_date - timedelta(days=550)
         
-        yf_ticker = yf.Ticker(ticker)
+        yf_ticker = get_ticker(ticker)
         
-        hist = await asyncio.to_thread(
-            yf_ticker.history, 
-            start=start_date.strftime('%Y-%m-%d'), 
-            end=end_date.strftime('%Y-%m-%d')
+        loop = asyncio.get_running_loop()
+        hist = await loop.run_in_executor(
+            YF_EXECUTOR,
+            partial(
+                yf_ticker.history,
+                start=start_date.strftime('%Y-%m-%d'),
+                end=end_date.strftime('%Y-%m-%d')
+            )
         )
         
         if hist.empty:
             return {"status": "error", "error": f"No data found for {ticker}"}
             
-        # Convert index (dates) to strings for JSON
-        hist_dict = {}
-        for index, row in hist.iterrows():
-            date_str = index.strftime('%Y-%m-%d')
-            hist_dict[date_str] = {
-                "Close": float(row['Close']),
-                "Dividends": float(row['Dividends']) if 'Dividends' in row else 0.0
-            }
-            
-        return {"status": "success", "data": hist_dict}
+        return orjson_response({"status": "success", "data": history_to_dict(hist)})
         
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": "error", "error": str(e)})
 
+# Matches FETCH_BATCH_SIZE in static/app.js; each batch holds YF_DOWNLOAD_LOCK, so an unbounded list would stall everyone else
+BATCH_MAX_TICKERS = 20
+
+@app.get("/api/proxy/yfinance_batch", response_class=JSONResponse)
+async def proxy_yfinance_batch(tickers: str):
+    """
+    Fetches several tickers (comma-separated, e.g. `1306.T,1321.T`) in one batched yfinance download.
+    Symbols without data are left out of the response.
+    """
+    # Same normalisation as get_ticker, since yf.download keys its columns by the upper-cased symbol
+    symbols = list(dict.fromkeys(t.strip().upper() for t in tickers.split(',') if t.strip()))
+    if not symbols:
+        return JSONResponse(status_code=400, content={"status": "error", "error": "No tickers given"})
+    if len(symbols) > BATCH_MAX_TICKERS:
+        return JSONResponse(status_code=400, content={"status": "error", "error": f"At most {BATCH_MAX_TICKERS} tickers per batch"})
+
+    try:
+        end_date = datetime.now() + timedelta(days=1)
+        start_date = end_date - timedelta(days=550)
+
+        # yf.download keeps its results in module-level state, so concurrent batches must not overlap.
+        # Batches are therefore served one at a time, and static/app.js sends them sequentially to match
+        async with YF_DOWNLOAD_LOCK:
+            loop = asyncio.get_running_loop()
+            all_hist = await loop.run_in_executor(
+                YF_EXECUTOR,
+                partial(
+                    yf.download,
+                    symbols,
+                    start=start_date.strftime('%Y-%m-%d'),
+                    end=end_date.strftime('%Y-%m-%d'),
+                    group_by='ticker',
+                    actions=True,
+                    threads=True,
+                    progress=False
+                )
+            )
+
+        data = {}
+        if all_hist is not None and not all_hist.empty:
+            fetched = set(all_hist.columns.get_level_values(0))
+            for symbol in symbols:
+                if symbol not in fetched:
+                    continue
+                # Rows where only the other symbols traded come back as NaN
+                hist = all_hist[symbol].dropna(subset=['Close'])
+                if not hist.empty:
+                    data[symbol] = history_to_dict(hist)
+
+        return orjson_response({"status": "success", "data": data})
+
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"status": "error", "error": str(e)})
+
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=True)
+    # Single worker on purpose: each process would start its own FX scheduler and send duplicate LINE alerts
+    uvicorn.run("app:app", host="127.0.0.1", port=8000, loop="uvloop", http="httptools")
@@ -1,18 +1,23 @@
 import os
+import asyncio
+import heapq
 from datetime import datetime, timedelta
+from collections import OrderedDict
+import httpx
 import yfinance as yf
 from fastapi import APIRouter, BackgroundTasks
-import requests
+from fastapi.responses import Response
+import orjson
 import pandas as pd
 import numpy as np
+import bottleneck as bn
 import pytz
 from scipy.cluster.hierarchy import linkage, fcluster
 from sklearn.metrics import silhouette_score
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, BroadcastRequest, TextMessage
 
 from google import genai
-from google import genai
-from apscheduler.schedulers.background import BackgroundScheduler
+from google.genai import types
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 router = APIRouter()
@@ -25,16 +30,20 @@ LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN", "")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 
 # LINE Messaging API クライアントの初期化
+# ブロードキャストは POST /v2/bot/message/broadcast 1本だけなので、SDKを使わず非同期HTTPクライアントで直接呼ぶ。
+# 接続を使い回すため、リクエストごとに作り直さずモジュールで1つを使い回す
+LINE_BROADCAST_URL = "https://api.line.me/v2/bot/message/broadcast"
+LINE_REQUEST_TIMEOUT = httpx.Timeout(5.0, connect=3.0)  # 応答がない場合に分析タスクが止まり続けないようにする
+# クライアントは閉じると再利用できないため、アプリ起動時に open_line_client() で作り、終了時に破棄する
 line_client = None
 if LINE_CHANNEL_ACCESS_TOKEN:
-    print(f"[INIT] LINE_CHANNEL_ACCESS_TOKEN is set (length: {len(LINE_CHANNEL_ACCESS_TOKEN)}). Initializing line_client...")
-    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-    api_client = ApiClient(configuration)
-    line_client = MessagingApi(api_client)
+    print(f"[INIT] LINE_CHANNEL_ACCESS_TOKEN is set (length: {len(LINE_CHANNEL_ACCESS_TOKEN)}).")
 else:
     print("[INIT] WARNING: LINE_CHANNEL_ACCESS_TOKEN is NOT set.")
 
 # Geminiクライアントの初期化 (APIキーがあれば)
+# LINEと同様にモジュールで1つを使い回す。SDKはクライアントごとにHTTPセッションを保持するため、
+# 呼び出しのたびに作り直すとその都度TLSハンドシェイクが発生する
 ai_client = None
 if GEMINI_API_KEY:
     ai_client = genai.Client(api_key=GEMINI_API_KEY)
@@ -61,52 +70,165 @@ SWING_WINDOW_MINOR = 5   # マイナースイング（トレンド判定）の
 # バックグラウンドスケジューラー
 _scheduler = None
 
+# yfinance 足データのキャッシュ: (シンボル, period, interval) -> (取得時刻, DataFrame, 全期間を取得した時刻)
+# トリガーのたびに同じ足を再ダウンロードしないよう、足の種類ごとの有効期間だけ使い回す。
+# 有効期間が切れたら直近1日分だけ取得して末尾に継ぎ足し、全期間の再取得は1日に1回に抑える
+_HIST_CACHE = {}
+HIST_CACHE_TTL_SECONDS = {"15m": 600, "1h": 1800}  # 15分足は10分、1時間足は30分
+HIST_FULL_REFRESH_SECONDS = 86400  # 全期間を取り直す間隔（1日）
+HIST_INCREMENTAL_PERIOD = "1d"     # 継ぎ足し時に取得する期間
+
+
+def _download_history(ticker, period: str, interval: str) -> pd.DataFrame:
+    # FXには配当・分割がないため、配当/分割列の付与・価格調整・時間外データ・欠損補修は行わない
+    return ticker.history(period=period, interval=interval,
+                          actions=False, auto_adjust=False, prepost=False, repair=False)
+
+
+# ===== ⓪ 価格データ取得（TTLキャッシュ付き） =====
+def fetch_history(ticker, period: str, interval: str, max_age_seconds: float = None) -> pd.DataFrame:
+    """
+    足データをTTLキャッシュ経由で取得する。
+    有効期間内なら前回のDataFrameを返し、yfinanceへのHTTPリクエストを省略する。
+    有効期間切れの場合は直近分だけを取得して前回のDataFrameにマージする
+    （取得分が前回の最終足と重ならない場合や、全期間の取得から1日経った場合は全期間を取り直す）。
+    max_age_seconds: キャッシュの有効期間（秒）。省略時は足の種類ごとの既定値。
+                     0 なら必ず取り直し、float('inf') ならキャッシュがある限りそれを使う。
+    ※ fast_info['lastPrice'] はライブ値なのでキャッシュしない
+    """
+    if max_age_seconds is None:
+        max_age_seconds = HIST_CACHE_TTL_SECONDS.get(interval, 0)
+    key = (ticker.ticker, period, interval)
+    now = datetime.now(JST)
+    cached = _HIST_CACHE.get(key)
+    if cached is not None and (now - cached[0]).total_seconds() < max_age_seconds:
+        return cached[1]
+
+    if cached is not None and (now - cached[2]).total_seconds() < HIST_FULL_REFRESH_SECONDS:
+        cached_df = cached[1]
+        recent = _download_history(ticker, HIST_INCREMENTAL_PERIOD, interval)
+        if not recent.empty and recent.index[0] <= cached_df.index[-1]:
+            # 形成中だった最終足は新しい値で置き換え、本数は全期間取得時と同じに揃える
+            merged = pd.concat([cached_df, recent])
+            merged = merged[~merged.index.duplicated(keep='last')].tail(len(cached_df))
+            _HIST_CACHE[key] = (now, merged, cached[2])
+            return merged
+
+    df = _download_history(ticker, period, interval)
+    if not df.empty:
+        _HIST_CACHE[key] = (now, df, now)
+    return df
+
+
+def fetch_last_price(symbol: str) -> float:
+    """
+    ライブ価格（fast_info['lastPrice']）を取得する。
+    FastInfoは取得した値をTickerインスタンスに保持するため、毎回新しいTickerで問い合わせる。
+    """
+    return yf.Ticker(symbol).fast_info['lastPrice']
+
 
 # ===== ① LINE送信 =====
-def send_line_message(message: str):
+async def send_line_message(*messages: str):
+    """
+    1件以上のテキストを1回のブロードキャストで送信する（LINEは1リクエスト最大5件まで）。
+    """
     if not line_client:
         print("[WARNING] LINE_CHANNEL_ACCESS_TOKEN が設定されていません。LINEへの通知はスキップされます。")
         return
 
     try:
-        broadcast_request = BroadcastRequest(
-            messages=[TextMessage(text=message.replace("\\n", "\n"))]
-        )
-        print("Sending BroadcastRequest to LINE API...")
-        response = line_client.broadcast(broadcast_request)
-        print(f"LINE Messaging API (Broadcast) response: {response}")
+        payload = {"messages": [{"type": "text", "text": m.replace("\\n", "\n")} for m in messages]}
+        print("Sending broadcast request to LINE API...")
+        response = await line_client.post(LINE_BROADCAST_URL, json=payload)
+        response.raise_for_status()
+        print(f"LINE Messaging API (Broadcast) response: {response.status_code}")
+    except httpx.HTTPStatusError as e:
+        print(f"LINE Messaging API 送信エラー: {type(e).__name__} - {e}")
+        print(f"Error Details: {e.response.text}")
     except Exception as e:
         print(f"LINE Messaging API 送信エラー: {type(e).__name__} - {e}")
-        if hasattr(e, 'body'):
-            print(f"Error Details: {e.body}")
 
 
-# ===== ② Gemini AI分析 =====
-def get_ai_analysis(market_context: str) -> str:
-    """豊富な相場データを基にGemini APIで分析させる"""
-    if not ai_client:
-        return ""
+def open_line_client():
+    """アプリ起動時にLINE送信用のHTTPクライアントを作成する（トークン未設定なら何もしない）"""
+    global line_client
+    if not LINE_CHANNEL_ACCESS_TOKEN or line_client is not None:
+        return
+    print("[INIT] Initializing line_client...")
+    # 送信は1回の分析につき1件を行うだけなので、小さいプールで接続を使い回す
+    line_client = httpx.AsyncClient(
+        http2=True,
+        timeout=LINE_REQUEST_TIMEOUT,
+        limits=httpx.Limits(max_connections=2),
+        headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+    )
+
 
-    prompt = f"""
-あなたは優秀なFX（ドル円）の専属アナリストです。
-以下の詳細な相場データに基づいて、トレーダーに向けて【具体的で実践的なアドバイス】を書いてください。
+async def close_line_client():
+    """アプリ終了時にLINE送信用のHTTPクライアントを閉じる"""
+    global line_client
+    if line_client is not None:
+        await line_client.aclose()
+        line_client = None
+
+
+# ===== ② Gemini AI分析 =====
+# Gemini応答のキャッシュ（LRU）: 相場データ -> 応答テキスト
+# コンテキストの価格は0.01円単位で整形済みのため、レンジ相場では同じ相場データが繰り返し生成される。
+# 同一の相場データに対する応答は使い回し、APIの待ち時間と課金を省く（失敗時はキャッシュしない）
+_AI_CACHE = OrderedDict()
+AI_CACHE_MAXSIZE = 128
+GEMINI_TIMEOUT_SECONDS = 5  # 応答待ちの上限（超えたらAIコメントなしで通知する）
+
+# 役割とルールは毎回同じなので、プロンプト本文ではなくシステム指示として固定で渡す
+# （可変部分は相場データのみ。明示的なコンテキストキャッシュは最小トークン数に満たないため使わない）
+AI_SYSTEM_INSTRUCTION = """あなたは優秀なFX（ドル円）の専属アナリストです。
+渡される詳細な相場データに基づいて、トレーダーに向けて【具体的で実践的なアドバイス】を書いてください。
 
 ルール:
 - 「情報が不足」という回答は禁止。提供されたデータだけで判断すること。
 - 「売り・買い・様子見」のいずれかの方向性を必ず示すこと。
 - 注目すべき価格ラインや打診ポイントを具体的に示すこと。
 - 文字数は150文字以内。冗長な挨拶は不要。
-
-{market_context}
 """
-    try:
-        response = ai_client.models.generate_content(
+AI_GENERATE_CONFIG = types.GenerateContentConfig(system_instruction=AI_SYSTEM_INSTRUCTION)
+
+
+async def _generate_ai_text(market_context: str) -> str:
+    """
+    Gemini APIを非同期クライアント（ai_client.aio）で呼び出して応答テキストを返す。
+    失敗・タイムアウト時は例外を送出する。
+    """
+    text = _AI_CACHE.get(market_context)
+    if text is not None:
+        _AI_CACHE.move_to_end(market_context)
+        return text
+
+    response = await asyncio.wait_for(
+        ai_client.aio.models.generate_content(
             model='gemini-3.0-flash',
-            contents=prompt,
-        )
-        return f"\n\n🤖AIアナリストのひとこと:\n{response.text.strip()}"
+            contents=market_context,
+            config=AI_GENERATE_CONFIG,
+        ),
+        timeout=GEMINI_TIMEOUT_SECONDS,
+    )
+    text = response.text.strip()
+    _AI_CACHE[market_context] = text
+    if len(_AI_CACHE) > AI_CACHE_MAXSIZE:
+        _AI_CACHE.popitem(last=False)
+    return text
+
+
+async def get_ai_analysis(market_context: str) -> str:
+    """豊富な相場データを基にGemini APIで分析させる"""
+    if not ai_client:
+        return ""
+
+    try:
+        return f"\n\n🤖AIアナリストのひとこと:\n{await _generate_ai_text(market_context)}"
     except Exception as e:
-        print(f"Gemini APIエラー: {e}")
+        print(f"Gemini APIエラー: {type(e).__name__} - {e}")
         return ""
 
 
@@ -166,23 +288,37 @@ def update_prev_state(res_mean: float, sup_mean: float, price_zone: str, trend_s
     _prev_state["trend_status"] = trend_status
 
 
+def try_claim_notification(now: datetime, bypass_cooldown: bool = False) -> bool:
+    """
+    クールダウンを確認し、通知してよければその場で最終通知時刻を更新して True を返す。
+    判定と更新の間に await を挟まないため、スケジューラーと /trigger の実行が重なっても二重に通知しない。
+    bypass_cooldown: 重要な変化（壁レベル変化・トレンド変化）の場合はクールダウン中でも通知する
+    """
+    global _last_notification_time
+    if not bypass_cooldown and _last_notification_time is not None:
+        elapsed = (now - _last_notification_time).total_seconds() / 60
+        if elapsed < NOTIFICATION_COOLDOWN_MINUTES:
+            print(f"  クールダウン中（前回通知から{elapsed:.0f}分経過、{NOTIFICATION_COOLDOWN_MINUTES}分必要）。通知をスキップします。")
+            return False
+    _last_notification_time = now
+    return True
+
+
 # ===== ④-B 階層型クラスタリングによるサポート/レジスタンス検出 =====
-def detect_support_resistance(df: pd.DataFrame) -> dict:
+def detect_support_resistance(highs: np.ndarray, lows: np.ndarray) -> dict:
     """
-    直近32本（8時間分）の15分足データから、階層型クラスタリングを用いて
+    直近32本（8時間分）の15分足の高値・安値配列から、階層型クラスタリングを用いて
     天井（レジスタンス帯）と底（サポート帯）を動的に検出する。
     固定閾値は一切使用せず、ボラティリティに自動適応する。
     """
-    if df.empty or len(df) < 2:
+    if len(highs) < 2:
         return {
             "resistance": {"mean_price": 0.0, "max": 0.0, "min": 0.0, "count": 0},
             "support": {"mean_price": 0.0, "max": 0.0, "min": 0.0, "count": 0},
         }
 
     # --- Step 1: High と Low を結合して1次元の価格配列を作成 ---
-    highs = df['High'].values.astype(float)
-    lows = df['Low'].values.astype(float)
-    prices = np.concatenate([highs, lows])
+    prices = np.concatenate([highs, lows]).astype(float, copy=False)
 
     # クラスタリングには2次元配列が必要 (n_samples, 1)
     X = prices.reshape(-1, 1)
@@ -202,11 +338,14 @@ def detect_support_resistance(df: pd.DataFrame) -> dict:
     best_score = -1.0
     max_k = min(5, len(X) - 1)  # データ数より多いkは不可
 
+    # 点間距離はkによらないため、1次元の絶対差で一度だけ求めて各kのスコア計算で使い回す
+    distances = np.abs(prices[:, None] - prices[None, :])
+
     for k in range(3, max_k + 1):
         labels = fcluster(Z, t=k, criterion='maxclust')
         if len(set(labels)) < 2:
             continue
-        score = silhouette_score(X, labels)
+        score = silhouette_score(distances, labels, metric='precomputed')
         if score > best_score:
             best_score = score
             best_k = k
@@ -214,21 +353,29 @@ def detect_support_resistance(df: pd.DataFrame) -> dict:
     # 最適kでクラスタリング実行
     labels = fcluster(Z, t=best_k, criterion='maxclust')
 
-    # --- Step 3: 各クラスタの統計を算出し、天井と底を判定 ---
+    # --- Step 3: 各クラスタの統計をまとめて算出し、天井と底を判定 ---
+    # 件数・最大・最小は1回のグループ集計で求める
+    # 平均はbincountだと加算順が変わり丸め結果がずれるため、従来どおりクラスタごとに .mean() で求める
+    cluster_ids, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    means = np.array([round(float(prices[inverse == j].mean()), 3) for j in range(len(cluster_ids))])
+    maxs = np.full(len(cluster_ids), -np.inf)
+    mins = np.full(len(cluster_ids), np.inf)
+    np.maximum.at(maxs, inverse, prices)
+    np.minimum.at(mins, inverse, prices)
+
     cluster_stats = {}
-    for label in set(labels):
-        cluster_prices = prices[labels == label]
+    for j, label in enumerate(cluster_ids):
         cluster_stats[label] = {
-            "mean_price": round(float(cluster_prices.mean()), 3),
-            "max": round(float(cluster_prices.max()), 3),
-            "min": round(float(cluster_prices.min()), 3),
-            "count": int(len(cluster_prices)),
+            "mean_price": float(means[j]),
+            "max": round(float(maxs[j]), 3),
+            "min": round(float(mins[j]), 3),
+            "count": int(counts[j]),
         }
 
     # 平均価格が最も高いクラスタ → レジスタンス（天井）
-    resistance_label = max(cluster_stats, key=lambda l: cluster_stats[l]["mean_price"])
+    resistance_label = cluster_ids[int(np.argmax(means))]
     # 平均価格が最も低いクラスタ → サポート（底）
-    support_label = min(cluster_stats, key=lambda l: cluster_stats[l]["mean_price"])
+    support_label = cluster_ids[int(np.argmin(means))]
 
     # --- Step 4: 結果を返却 ---
     return {
@@ -240,10 +387,11 @@ def detect_support_resistance(df: pd.DataFrame) -> dict:
     }
 
 
-def cluster_to_zone(cluster_info: dict, zone_type: str) -> dict:
+def cluster_to_zone(cluster_info: dict, zone_type: str, now_jst: datetime) -> dict:
     """
     detect_support_resistance()のクラスタリング出力を、
     メッセージ生成関数が期待するゾーン辞書形式に変換するアダプター。
+    now_jst: 分析実行時刻。反応履歴の時刻として使い、表示用の文字列もここで一度だけ整形する。
     """
     count = cluster_info["count"]
     # データポイント数に基づく強さ（★〜★★★）
@@ -263,54 +411,59 @@ def cluster_to_zone(cluster_info: dict, zone_type: str) -> dict:
         "strength_str": "★" * stars,
         "avg_wick_ratio": 0.0,
         "reactions": [{"price": cluster_info["mean_price"],
-                       "timestamp": datetime.now(JST),
+                       "timestamp": now_jst,
+                       "ts_str": now_jst.strftime("%m/%d %H:%M"),
                        "wick_ratio": 0.0,
                        "type": zone_type}],
     }
 
 
 # ===== ④ Stage 1: スイングポイント検出（プライスアクション） =====
-def detect_swing_points(df: pd.DataFrame, window: int):
+def detect_swing_points(index: pd.Index, opens: np.ndarray, highs: np.ndarray,
+                        lows: np.ndarray, closes: np.ndarray, window: int):
     """
     確定済みスイングハイ/ローを検出する。
     各ポイントに価格・時刻・ヒゲ比率・タイプを返す。
+    index / opens / highs / lows / closes: 足データの時刻と四本値（run_analysis_task で一度だけ取り出したもの）
     window: 左右何本の足で比較するか
     """
-    if df.empty or len(df) < window * 2 + 1:
+    n = len(highs)
+    if n < window * 2 + 1:
         return []
 
-    df = df.copy()
-    points = []
+    # 各足を中心とした前後window本の窓の最大/最小を一括計算し、中心の足が窓の極値ならスイングとみなす
+    # （確定済みのスイングポイントのみ: 両端のwindow本は窓が揃わないので対象外）
+    # bn.move_max は末尾基準の窓なので、span-1 本目以降が「window 本前の足を中心とした窓」に対応する
+    # 高値と符号反転した安値を1つの配列に重ね、窓の最大値1回の計算で天井・底の両方を判定する
+    span = window * 2 + 1
+    stacked = np.stack([highs, -lows])
+    is_swing_high, is_swing_low = stacked[:, window:n - window] >= bn.move_max(stacked, span, axis=1)[:, span - 1:]
+
+    # スイング候補の足だけを取り出し、実体・ヒゲ比率を配列演算でまとめて求める
+    offsets = np.flatnonzero(is_swing_high | is_swing_low)
+    idx = offsets + window
+    o = opens[idx]
+    h = highs[idx]
+    l = lows[idx]
+    c = closes[idx]
+    body = np.maximum(np.abs(c - o), 0.001)  # ゼロ除算防止
+    upper_wick_ratio = (h - np.maximum(o, c)) / body
+    lower_wick_ratio = (np.minimum(o, c) - l) / body
 
-    # 確定済みのスイングポイントのみ（最新のwindow本は未確定なので除外）
-    for i in range(window, len(df) - window):
-        row = df.iloc[i]
-        high = float(row['High'])
-        low = float(row['Low'])
-        open_price = float(row['Open'])
-        close = float(row['Close'])
-        timestamp = df.index[i]
-
-        body = abs(close - open_price)
-        if body < 0.001:
-            body = 0.001  # ゼロ除算防止
-
-        # --- スイングハイ（天井）判定 ---
-        is_swing_high = True
-        for j in range(i - window, i + window + 1):
-            if j == i:
-                continue
-            if float(df.iloc[j]['High']) > high:
-                is_swing_high = False
-                break
-
-        if is_swing_high:
-            upper_wick = high - max(open_price, close)
-            wick_ratio = upper_wick / body
+    points = []
+    for j, (offset, i) in enumerate(zip(offsets.tolist(), idx.tolist())):
+        high = float(h[j])
+        low = float(l[j])
+        open_price = float(o[j])
+        close = float(c[j])
+        timestamp = index[i]
+
+        # --- スイングハイ（天井） ---
+        if is_swing_high[offset]:
             points.append({
                 "price": high,
                 "timestamp": timestamp,
-                "wick_ratio": round(wick_ratio, 2),
+                "wick_ratio": round(float(upper_wick_ratio[j]), 2),
                 "type": "resistance",
                 "high": high,
                 "low": low,
@@ -318,22 +471,12 @@ def detect_swing_points(df: pd.DataFrame, window: int):
                 "close": close,
             })
 
-        # --- スイングロー（底）判定 ---
-        is_swing_low = True
-        for j in range(i - window, i + window + 1):
-            if j == i:
-                continue
-            if float(df.iloc[j]['Low']) < low:
-                is_swing_low = False
-                break
-
-        if is_swing_low:
-            lower_wick = min(open_price, close) - low
-            wick_ratio = lower_wick / body
+        # --- スイングロー（底） ---
+        if is_swing_low[offset]:
             points.append({
                 "price": low,
                 "timestamp": timestamp,
-                "wick_ratio": round(wick_ratio, 2),
+                "wick_ratio": round(float(lower_wick_ratio[j]), 2),
                 "type": "support",
                 "high": high,
                 "low": low,
@@ -344,26 +487,74 @@ def detect_swing_points(df: pd.DataFrame, window: int):
     return points
 
 
+# スイングポイント検出結果のキャッシュ: (本数, 最終足の時刻・高値・安値, window) -> points
+# 足データがキャッシュから再利用された場合など、同じ足に対する再計算を省く
+# （形成中の最終足は高値・安値が更新されうるため、それもキーに含める）
+_SWING_CACHE = {}
+
+
+def _last_bar_key(index: pd.Index, highs: np.ndarray, lows: np.ndarray) -> tuple:
+    """足データの同一性判定用キー（本数と最終足の時刻・高値・安値）"""
+    if len(index) == 0:
+        return (0,)
+    return (len(index), index[-1], float(highs[-1]), float(lows[-1]))
+
+
+def get_swing_points(index: pd.Index, opens: np.ndarray, highs: np.ndarray,
+                     lows: np.ndarray, closes: np.ndarray, window: int):
+    """最終足が前回と変わっていなければ前回の検出結果を返し、変わっていれば再検出する"""
+    key = (_last_bar_key(index, highs, lows), window)
+    points = _SWING_CACHE.get(key)
+    if points is None:
+        points = detect_swing_points(index, opens, highs, lows, closes, window)
+        _SWING_CACHE.clear()
+        _SWING_CACHE[key] = points
+    return points
+
+
+# クラスタリング結果のキャッシュ: (本数, 最終足の時刻・高値・安値, 対象本数) -> detect_support_resistance() の結果
+# 最終足が変わらない間は同じ足に対して Ward 法とシルエットスコアの計算を繰り返さない
+_SR_CACHE = {}
+
+
+def get_support_resistance(index: pd.Index, highs: np.ndarray, lows: np.ndarray, lookback: int) -> dict:
+    """直近lookback本の天井/底クラスタを、最終足が前回と変わっていなければ前回の結果から返す"""
+    key = (_last_bar_key(index, highs, lows), lookback)
+    sr = _SR_CACHE.get(key)
+    if sr is None:
+        sr = detect_support_resistance(highs[-lookback:], lows[-lookback:])
+        _SR_CACHE.clear()
+        _SR_CACHE[key] = sr
+    return sr
+
+
 # ===== ⑤-B Stage 2.5: トレンド判定 (プライスアクション / ダウ理論) =====
 def analyze_trend_pa(swing_points: list) -> dict:
     """
     スイングハイ・ローの切り上げ・切り下げ（ダウ理論）を用いて現在のトレンド状態を判定する。
+    swing_points は detect_swing_points() の出力どおり時系列順（古い順）であること。
     戻り値: {"status": "up"|"down"|"neutral", "details": str}
     """
-    # 昇順（古い順）にソート
-    sorted_pts = sorted(swing_points, key=lambda x: x["timestamp"])
-    
-    highs = [p for p in sorted_pts if p["type"] == "resistance"]
-    lows = [p for p in sorted_pts if p["type"] == "support"]
+    # 判定に使うのは直近2個ずつの高値・安値だけなので、全件をソート・分類せず末尾から拾う（新しい順）
+    highs = []
+    lows = []
+    for p in reversed(swing_points):
+        if p["type"] == "resistance":
+            if len(highs) < 2:
+                highs.append(p)
+        elif len(lows) < 2:
+            lows.append(p)
+        if len(highs) == 2 and len(lows) == 2:
+            break
     
     # 高値・安値のそれぞれが直近2個以上あるか確認
     if len(highs) < 2 or len(lows) < 2:
         return {"status": "neutral", "details": "トレンドを判定するためのスイングポイントが不足しています"}
 
     # 直近の高値と、その1個前の高値を比較 (High1 = 古い, High2 = 新しい)
-    high1, high2 = highs[-2]["price"], highs[-1]["price"]
+    high1, high2 = highs[1]["price"], highs[0]["price"]
     # 直近の安値と、その1個前の安値を比較 (Low1 = 古い, Low2 = 新しい)
-    low1, low2 = lows[-2]["price"], lows[-1]["price"]
+    low1, low2 = lows[1]["price"], lows[0]["price"]
 
     # 上昇トレンド定義: 高値の切り上げ (Higher High) AND 安値の切り上げ (Higher Low)
     if high2 > high1 and low2 > low1:
@@ -378,12 +569,24 @@ def analyze_trend_pa(swing_points: list) -> dict:
 
 
 # ===== ⑥ Stage 3: メッセージ生成 =====
-def build_alert_message(zone: dict, current_price: float, alert_type: str) -> tuple:
+# 反応履歴の説明文: (ゾーンタイプ, ヒゲの段階) -> 説明
+# ヒゲの段階 = (ヒゲ比率 >= 1.0) + (ヒゲ比率 >= 2.0) で 0〜2
+WICK_DESC = {
+    ("resistance", 0): "実体で到達後に反落",
+    ("resistance", 1): "上ヒゲで反落",
+    ("resistance", 2): "長い上ヒゲで強く反落",
+    ("support", 0): "実体で到達後に反発",
+    ("support", 1): "下ヒゲで反発",
+    ("support", 2): "長い下ヒゲで強く反発",
+}
+
+
+def build_alert_message(zone: dict, current_price: float, alert_type: str, now_str: str) -> tuple:
     """
     壁ゾーンの情報からLINE通知メッセージとAIコンテキストを生成する。
     alert_type: "resistance", "support", "range"
+    now_str: 見出しに表示する時刻（run_analysis_task で整形済みの文字列）
     """
-    now_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
     zone_price = zone["zone_price"]
     diff_pips = abs(current_price - zone_price) * 100  # 円→pips変換
 
@@ -400,41 +603,24 @@ def build_alert_message(zone: dict, current_price: float, alert_type: str) -> tu
         label = "膠着状態（レンジ）"
         action = "ブレイクアウトに警戒してください"
 
-    msg = f"📊 ドル円アラート（{now_str}）\n\n"
-    msg += f"【{emoji}{label}】{zone_price:.2f}円付近に接近中\n"
-    msg += f"　壁の強さ: {zone['strength_str']}（過去{zone['reaction_count']}回反発）\n"
-    msg += f"　現在価格: {current_price:.2f}円（壁まで{diff_pips:.0f}pips）\n"
-    msg += f"\n【根拠】\n"
+    # メッセージは部品をリストに溜めて最後に一度だけ連結する
+    msg_parts = [
+        f"📊 ドル円アラート（{now_str}）\n\n",
+        f"【{emoji}{label}】{zone_price:.2f}円付近に接近中\n",
+        f"　壁の強さ: {zone['strength_str']}（過去{zone['reaction_count']}回反発）\n",
+        f"　現在価格: {current_price:.2f}円（壁まで{diff_pips:.0f}pips）\n",
+        "\n【根拠】\n",
+    ]
 
     # 過去の反応履歴（最大3件）
     for reaction in zone["reactions"][:3]:
-        ts = reaction["timestamp"]
-        if hasattr(ts, 'tzinfo') and ts.tzinfo is not None:
-            ts = ts.astimezone(JST)
-        if hasattr(ts, 'strftime'):
-            ts_str = ts.strftime("%m/%d %H:%M")
-        else:
-            ts_str = str(ts)[:16]
-
         wick = reaction["wick_ratio"]
-        if reaction["type"] == "resistance":
-            if wick >= 2.0:
-                desc = "長い上ヒゲで強く反落"
-            elif wick >= 1.0:
-                desc = "上ヒゲで反落"
-            else:
-                desc = "実体で到達後に反落"
-        else:
-            if wick >= 2.0:
-                desc = "長い下ヒゲで強く反発"
-            elif wick >= 1.0:
-                desc = "下ヒゲで反発"
-            else:
-                desc = "実体で到達後に反発"
+        zone_type = "resistance" if reaction["type"] == "resistance" else "support"
+        desc = WICK_DESC[(zone_type, (wick >= 1.0) + (wick >= 2.0))]
+        msg_parts.append(f"・{reaction['ts_str']} {desc}（{reaction['price']:.2f}円）\n")
 
-        msg += f"・{ts_str} {desc}（{reaction['price']:.2f}円）\n"
-
-    msg += f"\n※{action}"
+    msg_parts.append(f"\n※{action}")
+    msg = "".join(msg_parts)
 
     ai_context = (
         f"現在価格{current_price:.2f}円。"
@@ -447,18 +633,19 @@ def build_alert_message(zone: dict, current_price: float, alert_type: str) -> tu
     return msg, ai_context
 
 
-def build_range_message(res_zone: dict, sup_zone: dict, current_price: float) -> tuple:
+def build_range_message(res_zone: dict, sup_zone: dict, current_price: float, now_str: str) -> tuple:
     """天井と底の両方に挟まれている場合のレンジメッセージ"""
-    now_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
     range_width = abs(res_zone["zone_price"] - sup_zone["zone_price"]) * 100
 
-    msg = f"📊 ドル円アラート（{now_str}）\n\n"
-    msg += f"【⚠️膠着状態】天井と底に挟まれています\n"
-    msg += f"　天井: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}（{res_zone['reaction_count']}回反発）\n"
-    msg += f"　底　: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}（{sup_zone['reaction_count']}回反発）\n"
-    msg += f"　現在: {current_price:.2f}円\n"
-    msg += f"　レンジ幅: 約{range_width:.0f}pips\n"
-    msg += f"\n※力を溜めている状態です。どちらかにブレイクアウトする可能性が高まっています。"
+    msg = "".join([
+        f"📊 ドル円アラート（{now_str}）\n\n",
+        "【⚠️膠着状態】天井と底に挟まれています\n",
+        f"　天井: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}（{res_zone['reaction_count']}回反発）\n",
+        f"　底　: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}（{sup_zone['reaction_count']}回反発）\n",
+        f"　現在: {current_price:.2f}円\n",
+        f"　レンジ幅: 約{range_width:.0f}pips\n",
+        "\n※力を溜めている状態です。どちらかにブレイクアウトする可能性が高まっています。",
+    ])
 
     ai_context = (
         f"現在価格{current_price:.2f}円。"
@@ -472,9 +659,8 @@ def build_range_message(res_zone: dict, sup_zone: dict, current_price: float) ->
 
 
 # ===== ⑥-C: トレンドメッセージ生成 (プライスアクション版) =====
-def build_trend_message(trend_info: dict, current_price: float) -> tuple:
+def build_trend_message(trend_info: dict, current_price: float, now_str: str) -> tuple:
     """トレンド発生/継続時のLINE通知メッセージを作成"""
-    now_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
     
     if trend_info["status"] == "up":
         emoji = "📈"
@@ -485,12 +671,13 @@ def build_trend_message(trend_info: dict, current_price: float) -> tuple:
         trend_name = "下落トレンド"
         color = "売り優勢"
         
-    msg = f"📊 ドル円トレンド通知（{now_str}）\n\n"
-    msg += f"【{emoji}{trend_name}】{color}の相場になっています\n"
-    msg += f"　サイン: {trend_info['details']}\n"
-    msg += f"　現在価格: {current_price:.2f}円\n\n"
-    
-    msg += "※ダウ理論に基づき、直近の波形（プライスアクション）からトレンドを判定しています。トレンド方向への順張りが有効な場面です。"
+    msg = "".join([
+        f"📊 ドル円トレンド通知（{now_str}）\n\n",
+        f"【{emoji}{trend_name}】{color}の相場になっています\n",
+        f"　サイン: {trend_info['details']}\n",
+        f"　現在価格: {current_price:.2f}円\n\n",
+        "※ダウ理論に基づき、直近の波形（プライスアクション）からトレンドを判定しています。トレンド方向への順張りが有効な場面です。",
+    ])
 
     ai_context = (
         f"現在価格{current_price:.2f}円。"
@@ -502,65 +689,80 @@ def build_trend_message(trend_info: dict, current_price: float) -> tuple:
 
 
 # ===== ⑥-B: AIに渡す豊富な相場コンテキストの構築 =====
-def build_full_ai_context(df: pd.DataFrame, current_price: float, zones: list, alert_context: str) -> str:
+def build_full_ai_context(opens: np.ndarray, highs: np.ndarray, lows: np.ndarray, closes: np.ndarray,
+                          current_price: float, zones: list, alert_context: str) -> str:
     """
     AIに渡すための包括的な相場データを構築する。
     - 直近の値動きサマリー（高値・安値・方向感）
     - 検出された全ゾーン（壁）の一覧
     - 今回のアラート内容
+    opens / highs / lows / closes: 15分足の四本値（run_analysis_task で一度だけ取り出したndarray）
     """
-    context = "【アラート内容】\n"
-    context += alert_context + "\n\n"
+    # コンテキストは行をリストに溜めて最後に一度だけ連結する
+    parts = ["【アラート内容】\n", alert_context, "\n\n"]
 
     # --- 直近の値動きサマリー ---
-    context += "【直近の値動き】\n"
-
-    if not df.empty and len(df) >= 2:
-        # 直近24時間（15分足×96本）の値動き
-        recent = df.tail(96) if len(df) >= 96 else df
-        recent_high = float(recent['High'].max())
-        recent_low = float(recent['Low'].min())
-        recent_open = float(recent['Open'].iloc[0])
-        recent_close = float(recent['Close'].iloc[-1])
+    parts.append("【直近の値動き】\n")
+
+    if len(closes) >= 2:
+        # 直近24時間（15分足×96本）の値動き（本数が足りなければ全体。末尾スライスはコピーを作らない）
+        recent_high = float(highs[-96:].max())
+        recent_low = float(lows[-96:].min())
+        recent_open = float(opens[-96:][0])
+        recent_close = float(closes[-1])
         change = recent_close - recent_open
         direction = "上昇" if change > 0 else "下落" if change < 0 else "横ばい"
 
-        context += f"直近24時間: 高値{recent_high:.2f}円 / 安値{recent_low:.2f}円 / 値幅{(recent_high - recent_low)*100:.0f}pips\n"
-        context += f"方向: {direction}（{change:+.2f}円 / {change*100:+.0f}pips）\n"
+        parts.append(f"直近24時間: 高値{recent_high:.2f}円 / 安値{recent_low:.2f}円 / 値幅{(recent_high - recent_low)*100:.0f}pips\n")
+        parts.append(f"方向: {direction}（{change:+.2f}円 / {change*100:+.0f}pips）\n")
 
         # 直近4時間（15分足×16本）のトレンド
-        very_recent = df.tail(16) if len(df) >= 16 else df
-        vr_open = float(very_recent['Open'].iloc[0])
-        vr_close = float(very_recent['Close'].iloc[-1])
+        vr_open = float(opens[-16:][0])
+        vr_close = recent_close
         vr_change = vr_close - vr_open
         vr_dir = "上昇中" if vr_change > 0.02 else "下落中" if vr_change < -0.02 else "もみ合い"
-        context += f"直近4時間の勢い: {vr_dir}（{vr_change:+.2f}円）\n"
+        parts.append(f"直近4時間の勢い: {vr_dir}（{vr_change:+.2f}円）\n")
 
-    context += f"現在価格: {current_price:.2f}円\n\n"
+    parts.append(f"現在価格: {current_price:.2f}円\n\n")
 
     # --- 全ゾーン一覧（壁の地図） ---
-    context += "【検出された壁（価格帯）の一覧】\n"
-    res_zones = sorted([z for z in zones if z["type"] == "resistance"], key=lambda z: z["zone_price"])
-    sup_zones = sorted([z for z in zones if z["type"] == "support"], key=lambda z: z["zone_price"], reverse=True)
+    parts.append("【検出された壁（価格帯）の一覧】\n")
+    # 1回の走査でレジスタンス/サポートに振り分け、現在価格からの距離（pips）も同時に求める
+    res_zones = []
+    sup_zones = []
+    for z in zones:
+        dist = (z["zone_price"] - current_price) * 100
+        if z["type"] == "resistance":
+            res_zones.append((z, dist))
+        elif z["type"] == "support":
+            sup_zones.append((z, dist))
+    # 表示するのは上位5つだけなので、全件ソートせず上位k件だけを取り出す
+    res_zones = heapq.nsmallest(5, res_zones, key=lambda zd: zd[0]["zone_price"])
+    sup_zones = heapq.nlargest(5, sup_zones, key=lambda zd: zd[0]["zone_price"])
 
     if res_zones:
-        context += "▲ レジスタンス（上値の壁）:\n"
-        for z in res_zones[:5]:  # 上位5つ
-            dist = (z["zone_price"] - current_price) * 100
-            context += f"  {z['zone_price']:.2f}円 {z['strength_str']} 反応{z['reaction_count']}回 (現在価格から{dist:+.0f}pips)\n"
+        parts.append("▲ レジスタンス（上値の壁）:\n")
+        for z, dist in res_zones:  # 上位5つ
+            parts.append(f"  {z['zone_price']:.2f}円 {z['strength_str']} 反応{z['reaction_count']}回 (現在価格から{dist:+.0f}pips)\n")
 
     if sup_zones:
-        context += "▼ サポート（下値の壁）:\n"
-        for z in sup_zones[:5]:  # 上位5つ
-            dist = (z["zone_price"] - current_price) * 100
-            context += f"  {z['zone_price']:.2f}円 {z['strength_str']} 反応{z['reaction_count']}回 (現在価格から{dist:+.0f}pips)\n"
-            
-    return context
+        parts.append("▼ サポート（下値の壁）:\n")
+        for z, dist in sup_zones:  # 上位5つ
+            parts.append(f"  {z['zone_price']:.2f}円 {z['strength_str']} 反応{z['reaction_count']}回 (現在価格から{dist:+.0f}pips)\n")
+
+    return "".join(parts)
 
 
 # ===== ⑦ メインの分析タスク =====
-def run_analysis_task(force: bool = False):
+async def run_analysis_task(force: bool = False, bars_max_age: float = None):
+    """
+    足データとライブ価格を取得し、壁・トレンドの変化を判定して通知する。
+    force: 条件を無視してテスト通知を送る
+    bars_max_age: 足データのキャッシュ有効期間（秒）。fetch_history() の max_age_seconds にそのまま渡す
+    """
+    # 時刻は実行開始時に1回だけ取得し、曜日判定・クールダウン判定・メッセージの時刻表示で共有する
     now_jst = datetime.now(JST)
+    now_str = now_jst.strftime("%Y/%m/%d %H:%M")  # メッセージ見出し用（各ビルダーに渡す）
     print(f"[{now_jst}] 価格チェックを開始します... (force={force})")
 
     # 土日は通知をスキップ（FXは土日休場のため）
@@ -572,31 +774,44 @@ def run_analysis_task(force: bool = False):
     try:
         ticker = yf.Ticker('JPY=X')
 
-        # データ取得: 過去5日の15分足（スイング検出に十分な本数を確保）
-        df = ticker.history(period='5d', interval='15m')
+        # データ取得: 過去5日の15分足（スイング検出に十分な本数を確保）とライブ価格を並行して取得
+        # yfinanceは同期APIのため別スレッドで実行し、イベントループはブロックしない
+        df, current_price = await asyncio.gather(
+            asyncio.to_thread(fetch_history, ticker, '5d', '15m', bars_max_age),
+            asyncio.to_thread(fetch_last_price, ticker.ticker),
+            return_exceptions=True,
+        )
+        if isinstance(df, Exception):
+            raise df
+        if isinstance(current_price, Exception):
+            current_price = None
 
         if df.empty:
             print("yfinanceから価格データの取得に失敗しました。")
             return
 
-        try:
-            current_price = ticker.fast_info['lastPrice']
-        except Exception:
-            current_price = float(df['Close'].iloc[-1].item()) if hasattr(df['Close'].iloc[-1], 'item') else float(df['Close'].iloc[-1])
+        # 四本値はここで一度だけndarrayに変換し、以降の各ステップで共有する
+        opens = df['Open'].to_numpy(dtype=float)
+        highs = df['High'].to_numpy(dtype=float)
+        lows = df['Low'].to_numpy(dtype=float)
+        closes = df['Close'].to_numpy(dtype=float)
+
+        if current_price is None:
+            current_price = float(closes[-1])
 
         print(f"現在価格: {current_price:.3f}円")
 
         # ===== クラスタリングベース分析パイプライン =====
 
         # Step 1: クラスタリングで天井/底を検出（直近8時間 = 32本）
-        df_recent = df.tail(32) if len(df) >= 32 else df
-        sr = detect_support_resistance(df_recent)
-        res_zone = cluster_to_zone(sr["resistance"], "resistance")
-        sup_zone = cluster_to_zone(sr["support"], "support")
+        # DataFrameを切り出さず、高値・安値のndarrayの末尾スライス（ビュー）を渡す（最終足が同じなら前回の結果を再利用）
+        sr = get_support_resistance(df.index, highs, lows, lookback=32)
+        res_zone = cluster_to_zone(sr["resistance"], "resistance", now_jst)
+        sup_zone = cluster_to_zone(sr["support"], "support", now_jst)
         zones = [res_zone, sup_zone]  # 全ゾーン一覧（AI分析向け）
 
         # スイングポイントはトレンド判定（ダウ理論）専用
-        swing_points = detect_swing_points(df, window=SWING_WINDOW_MINOR)
+        swing_points = get_swing_points(df.index, opens, highs, lows, closes, window=SWING_WINDOW_MINOR)
         trend_info = analyze_trend_pa(swing_points)
 
         optimal_k = sr.get("optimal_k", "?")
@@ -608,30 +823,37 @@ def run_analysis_task(force: bool = False):
 
         # --- 強制テスト通知 ---
         if force:
-            test_msg = f"📊【🔧テスト通知】（{datetime.now(JST).strftime('%Y/%m/%d %H:%M')}）\n\n"
-            test_msg += f"現在価格: {current_price:.2f}円\n"
-            test_msg += f"検出ゾーン数: {len(zones)}個\n\n"
+            # メッセージは部品をリストに溜めて最後に一度だけ連結する
+            msg_parts = [
+                f"📊【🔧テスト通知】（{now_str}）\n\n",
+                f"現在価格: {current_price:.2f}円\n",
+                f"検出ゾーン数: {len(zones)}個\n\n",
+            ]
 
             if res_zone:
-                test_msg += f"🔴 最寄りレジスタンス: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}（{res_zone['reaction_count']}回反発）\n"
+                msg_parts.append(f"🔴 最寄りレジスタンス: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}（{res_zone['reaction_count']}回反発）\n")
             else:
-                test_msg += "🔴 レジスタンス: 検出なし\n"
+                msg_parts.append("🔴 レジスタンス: 検出なし\n")
             if sup_zone:
-                test_msg += f"🟢 最寄りサポート: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}（{sup_zone['reaction_count']}回反発）\n"
+                msg_parts.append(f"🟢 最寄りサポート: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}（{sup_zone['reaction_count']}回反発）\n")
             else:
-                test_msg += "🟢 サポート: 検出なし\n"
+                msg_parts.append("🟢 サポート: 検出なし\n")
 
-            test_alert_context = f"現在価格{current_price:.2f}円。テスト送信。"
+            context_parts = [f"現在価格{current_price:.2f}円。テスト送信。"]
             if res_zone:
-                test_alert_context += f"レジスタンス帯: {res_zone['zone_price']:.2f}円。"
+                context_parts.append(f"レジスタンス帯: {res_zone['zone_price']:.2f}円。")
             if sup_zone:
-                test_alert_context += f"サポート帯: {sup_zone['zone_price']:.2f}円。"
+                context_parts.append(f"サポート帯: {sup_zone['zone_price']:.2f}円。")
             if trend_info["status"] != "neutral":
-                test_alert_context += f"現在{trend_info['details']}のトレンドが発生中。"
+                context_parts.append(f"現在{trend_info['details']}のトレンドが発生中。")
 
-            full_context = build_full_ai_context(df, current_price, zones, test_alert_context)
-            test_msg += get_ai_analysis(full_context)
-            send_line_message(test_msg)
+            full_context = build_full_ai_context(opens, highs, lows, closes, current_price, zones, "".join(context_parts))
+            # テスト通知もAIコメントと1回のブロードキャストにまとめる
+            ai_text = (await get_ai_analysis(full_context)).strip()
+            if ai_text:
+                await send_line_message("".join(msg_parts), ai_text)
+            else:
+                await send_line_message("".join(msg_parts))
             print("強制テスト通知を送信しました。")
             return
 
@@ -661,6 +883,12 @@ def run_analysis_task(force: bool = False):
             update_prev_state(res_price, sup_price, current_price_zone, trend_info["status"])
             return
 
+        # 価格ゾーン・壁レベル・トレンドのいずれも変わっていなければ、アラート判定もメッセージ生成も不要
+        if not (zone_changed or zone_level_changed or trend_changed):
+            update_prev_state(res_price, sup_price, current_price_zone, trend_info["status"])
+            print("変化なし。通知不要です。")
+            return
+
         message = ""
         ai_context = ""
 
@@ -669,36 +897,34 @@ def run_analysis_task(force: bool = False):
             # -- 4a: 壁への接近（ゾーンに初めて入った） --
             if current_price_zone == "in_res" and res_zone:
                 if prev_zone != "in_res" or zone_level_changed:
-                    message, ai_context = build_alert_message(res_zone, current_price, "resistance")
+                    message, ai_context = build_alert_message(res_zone, current_price, "resistance", now_str)
 
             elif current_price_zone == "in_sup" and sup_zone:
                 if prev_zone != "in_sup" or zone_level_changed:
-                    message, ai_context = build_alert_message(sup_zone, current_price, "support")
+                    message, ai_context = build_alert_message(sup_zone, current_price, "support", now_str)
 
             elif current_price_zone == "range" and res_zone and sup_zone:
                 if prev_zone != "range" or zone_level_changed:
-                    message, ai_context = build_range_message(res_zone, sup_zone, current_price)
+                    message, ai_context = build_range_message(res_zone, sup_zone, current_price, now_str)
 
             # -- 4c: 壁レベルが変わった場合（ゾーンはmiddleだが壁の位置が変動） --
             elif zone_level_changed and current_price_zone == "middle":
-                now_str = datetime.now(JST).strftime("%Y/%m/%d %H:%M")
-                message = f"📊 ドル円アラート（{now_str}）\n\n"
-                message += f"【📐市場構造の変化を検出】\n"
-                if res_zone:
-                    message += f"　新しい天井帯: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}\n"
-                if sup_zone:
-                    message += f"　新しい底帯: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}\n"
-                message += f"　現在価格: {current_price:.2f}円（中間帯）"
-                ai_context = f"市場構造が変化。"
+                msg_parts = [f"📊 ドル円アラート（{now_str}）\n\n", "【📐市場構造の変化を検出】\n"]
+                context_parts = ["市場構造が変化。"]
                 if res_zone:
-                    ai_context += f"新レジスタンス{res_zone['zone_price']:.2f}円。"
+                    msg_parts.append(f"　新しい天井帯: {res_zone['zone_price']:.2f}円 {res_zone['strength_str']}\n")
+                    context_parts.append(f"新レジスタンス{res_zone['zone_price']:.2f}円。")
                 if sup_zone:
-                    ai_context += f"新サポート{sup_zone['zone_price']:.2f}円。"
-                ai_context += f"現在価格{current_price:.2f}円。"
+                    msg_parts.append(f"　新しい底帯: {sup_zone['zone_price']:.2f}円 {sup_zone['strength_str']}\n")
+                    context_parts.append(f"新サポート{sup_zone['zone_price']:.2f}円。")
+                msg_parts.append(f"　現在価格: {current_price:.2f}円（中間帯）")
+                context_parts.append(f"現在価格{current_price:.2f}円。")
+                message = "".join(msg_parts)
+                ai_context = "".join(context_parts)
 
         # -- 4d: トレンド変化の検出 --
         if not message and trend_changed and trend_info["status"] != "neutral":
-            message, ai_context = build_trend_message(trend_info, current_price)
+            message, ai_context = build_trend_message(trend_info, current_price, now_str)
 
         # Step 5: 状態を更新（通知の有無に関わらず毎回更新）
         update_prev_state(res_price, sup_price, current_price_zone, trend_info["status"])
@@ -706,27 +932,25 @@ def run_analysis_task(force: bool = False):
         # Step 6: メッセージ送信（クールダウンチェック付き）
         # 重要な変化（壁レベル変化・トレンド変化）はクールダウンをバイパス
         is_important_change = zone_level_changed or trend_changed
-        global _last_notification_time
-        if message:
-            # クールダウンチェック: 重要な変化でない場合のみ適用
-            if not is_important_change:
-                now = datetime.now(JST)
-                if _last_notification_time is not None:
-                    elapsed = (now - _last_notification_time).total_seconds() / 60
-                    if elapsed < NOTIFICATION_COOLDOWN_MINUTES:
-                        print(f"  クールダウン中（前回通知から{elapsed:.0f}分経過、{NOTIFICATION_COOLDOWN_MINUTES}分必要）。通知をスキップします。")
-                        message = ""
+        if message and not try_claim_notification(now_jst, bypass_cooldown=is_important_change):
+            message = ""
 
         if message:
+            ai_text = ""
             if ai_context:
                 if trend_info["status"] != "neutral":
                     ai_context += f"\n【現在のトレンド】\n{trend_info['details']}\n"
 
-                full_ai_context = build_full_ai_context(df, current_price, zones, ai_context)
-                message += get_ai_analysis(full_ai_context)
+                full_ai_context = build_full_ai_context(opens, highs, lows, closes, current_price, zones, ai_context)
+                # Geminiは GEMINI_TIMEOUT_SECONDS で打ち切られるので、待ってもアラートの遅れは高々数秒
+                ai_text = (await get_ai_analysis(full_ai_context)).strip()
 
-            send_line_message(message)
-            _last_notification_time = datetime.now(JST)
+            # アラートとAIコメントは1回のブロードキャストにまとめる（LINEの送信数はリクエスト単位で数えられる）
+            if ai_text:
+                await send_line_message(message, ai_text)
+                message += "\n\n" + ai_text
+            else:
+                await send_line_message(message)
             print("通知を送信しました:\n" + message)
         else:
             print("変化なし。通知不要です。")
@@ -737,24 +961,40 @@ def run_analysis_task(force: bool = False):
 
 # ===== ⑧ バックグラウンドスケジューラー =====
 def start_scheduler():
-    """平日のみ1分間隔で価格チェックを自動実行するスケジューラーを起動する"""
+    """
+    平日のみ5分間隔で価格チェックを自動実行するスケジューラーを起動する。
+    15分足の確定直後は足データを取り直して全体を分析し、その間はキャッシュ済みの足とライブ価格だけで判定する。
+    AsyncIOScheduler は実行中のイベントループ上でジョブ（コルーチン）を動かすため、
+    FastAPI の lifespan などイベントループ内から呼び出すこと。
+    """
     global _scheduler
     if _scheduler is not None:
         print("[SCHEDULER] スケジューラーは既に起動しています。")
         return
 
-    _scheduler = BackgroundScheduler(daemon=True)
-    # FX相場のアラートタスクを平日（月〜金）の5分ごと（0,5,10...分）に実行
+    _scheduler = AsyncIOScheduler()
+    # 15分足の確定直後（0,15,30,45分の10秒後。新しい足がyfinanceに反映されるのを待つ）に足データを取り直して分析
     _scheduler.add_job(
         run_analysis_task,
-        CronTrigger(day_of_week='mon-fri', minute='*/5', second='0'),
+        CronTrigger(day_of_week='mon-fri', minute='0,15,30,45', second='10'),
+        kwargs={"bars_max_age": 0},
         id='fx_analysis',
-        name='FX価格分析（1分間隔）',
+        name='FX価格分析（15分足の確定ごと）',
         replace_existing=True,
         misfire_grace_time=30,  # 30秒以内の遅延は許容
     )
+    # その間の5分ごとは足データを取得せず、キャッシュ済みの足とライブ価格だけで壁への接近を判定
+    _scheduler.add_job(
+        run_analysis_task,
+        CronTrigger(day_of_week='mon-fri', minute='5,10,20,25,35,40,50,55', second='0'),
+        kwargs={"bars_max_age": float('inf')},
+        id='fx_price_check',
+        name='FX価格チェック（足データはキャッシュ）',
+        replace_existing=True,
+        misfire_grace_time=30,
+    )
     _scheduler.start()
-    print("[SCHEDULER] FX分析スケジューラーを起動しました（平日5分間隔）")
+    print("[SCHEDULER] FX分析スケジューラーを起動しました（平日5分間隔、足データの更新は15分ごと）")
 
 
 def stop_scheduler():
@@ -766,15 +1006,22 @@ def stop_scheduler():
         print("[SCHEDULER] FX分析スケジューラーを停止しました")
 
 
+# 死活監視（cron-job.org）から頻繁に呼ばれるため、応答本文はスケジューラーの有無ごとに事前にシリアライズしておく
+_HEALTH_BODIES = {
+    running: orjson.dumps({"status": "ok", "message": "FX Bottom/Top Bot is running.", "scheduler": running})
+    for running in (True, False)
+}
+
+
 @router.get("/fx_health")
 def read_root():
-    return {"status": "ok", "message": "FX Bottom/Top Bot is running.", "scheduler": _scheduler is not None}
+    return Response(content=_HEALTH_BODIES[_scheduler is not None], media_type="application/json")
 
 @router.get("/trigger")
 def trigger_analysis(background_tasks: BackgroundTasks, force: bool = False):
     """
     手動テストや強制通知用エンドポイント。
-    スケジューラーが平日1分間隔で自動実行するため、通常はcronからの呼び出し不要。
+    スケジューラーが平日5分間隔で自動実行するため、通常はcronからの呼び出し不要。
     cron-job.org はRenderのスリープ防止（死活監視）用として使用。
     ?force=true をつけると条件無視で強制通知テストができます。
     """
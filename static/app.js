@@ -126,122 +126,163 @@ document.addEventListener('DOMContentLoaded', () => {
         return ((newPrice - oldPrice) / oldPrice) * 100;
     }
 
+    // Symbols per batched proxy request (the server caps it at BATCH_MAX_TICKERS in app.py).
+    // The server serialises yf.download (YF_DOWNLOAD_LOCK), so batches are sent one after another.
+    const FETCH_BATCH_SIZE = 20;
+
     async function fetchAllPrices(etfList, progressBar, progressText, progressCount, targetDateStr) {
         const total = etfList.length;
         const bDates = getBusinessDates(targetDateStr);
+        const batches = [];
+        for (let i = 0; i < total; i += FETCH_BATCH_SIZE) {
+            batches.push(etfList.slice(i, i + FETCH_BATCH_SIZE));
+        }
+        let completed = 0;
 
-        for (let i = 0; i < total; i++) {
-            const row = etfList[i];
+        for (const batch of batches) {
+            await fetchPriceBatch(batch, bDates);
 
             // Update Progress UI
-            const pct = Math.round(((i + 1) / total) * 100);
+            completed += batch.length;
+            const lastRow = batch[batch.length - 1];
+            const pct = Math.round((completed / total) * 100);
             progressBar.style.width = `${pct}%`;
-            progressText.textContent = `${row.code} ${row.name || ''}`;
-            progressCount.textContent = `${i + 1} / ${total}`;
-
-            try {
-                // Add tiny client-side delay to spread requests
-                await new Promise(r => setTimeout(r, 200));
-
-                const res = await fetch(`/api/proxy/yfinance/${row.clean_code}.T`);
-                const json = await res.json();
-
-                if (json.status === 'success' && json.data) {
-                    const hist = json.data;
-
-                    const getPriceForDate = (targetD) => {
-                        let d = new Date(targetD);
-                        for (let attempts = 0; attempts < 10; attempts++) {
-                            const dStr = d.toISOString().split('T')[0];
-                            if (hist[dStr]) return hist[dStr].Close;
-                            d.setDate(d.getDate() - 1); // Walk backwards
-                        }
-                        return null;
-                    };
-
-                    const currentPrice = getPriceForDate(bDates.target);
-                    const prevPrice = getPriceForDate(bDates.prev);
-                    const weekPrice = getPriceForDate(bDates.week);
-                    const twoWeekPrice = getPriceForDate(bDates.two_weeks);
-                    const yearPrice = getPriceForDate(bDates.year);
-
-                    row.price = currentPrice ? Math.round(currentPrice * 100) / 100 : null;
-                    row.change_1d_pct = formatPctChange(prevPrice, currentPrice);
-                    row.change_1w_pct = formatPctChange(weekPrice, currentPrice);
-                    row.change_2w_pct = formatPctChange(twoWeekPrice, currentPrice);
-                    row.change_1y_pct = formatPctChange(yearPrice, currentPrice);
-
-                    row.dividend_yield = "-";
-                    row.dividend_date = "-";
-
-                    let annualDiv = 0;
-                    const oneYearAgoTime = new Date().getTime() - (365 * 24 * 60 * 60 * 1000);
-                    let hasDivs = false;
-                    const divDates = [];
-
-                    Object.keys(hist).forEach(dStr => {
-                        const dTime = new Date(dStr).getTime();
-                        if (hist[dStr].Dividends > 0) {
-                            hasDivs = true;
-                            divDates.push(new Date(dStr));
-                            if (dTime > oneYearAgoTime) {
-                                annualDiv += hist[dStr].Dividends;
-                            }
-                        }
-                    });
-
-                    if (hasDivs && currentPrice && currentPrice > 0 && annualDiv > 0) {
-                        const calcYield = (annualDiv / currentPrice) * 100;
-                        row.dividend_yield = `${calcYield.toFixed(2)}%`;
-                    }
+            progressText.textContent = `${lastRow.code} ${lastRow.name || ''}`;
+            progressCount.textContent = `${completed} / ${total}`;
+        }
+        flushRender();
+    }
 
-                    if (hasDivs && divDates.length > 0) {
-                        divDates.sort((a, b) => a - b);
-                        const recentDivs = divDates.slice(-24);
-                        const today = new Date();
-
-                        const payoutMonths = [...new Set(recentDivs.map(d => d.getMonth() + 1))].sort((a, b) => a - b);
-                        const avgDayByMonth = {};
-                        payoutMonths.forEach(m => {
-                            const days = recentDivs.filter(d => (d.getMonth() + 1) === m).map(d => d.getDate());
-                            avgDayByMonth[m] = days.length > 0 ? Math.round(days.reduce((sum, d) => sum + d, 0) / days.length) : 10;
-                        });
-
-                        let nextMonth = null;
-                        let nextYear = today.getFullYear();
-                        let nextDay = null;
-
-                        const currentMonth = today.getMonth() + 1;
-                        const currentDay = today.getDate();
-
-                        for (let j = 0; j < payoutMonths.length; j++) {
-                            const m = payoutMonths[j];
-                            if (m === currentMonth && currentDay < avgDayByMonth[m]) {
-                                nextMonth = m;
-                                nextDay = avgDayByMonth[m];
-                                break;
-                            } else if (m > currentMonth) {
-                                nextMonth = m;
-                                nextDay = avgDayByMonth[m];
-                                break;
-                            }
-                        }
-
-                        if (!nextMonth && payoutMonths.length > 0) {
-                            nextMonth = payoutMonths[0];
-                            nextYear += 1;
-                            nextDay = avgDayByMonth[nextMonth];
-                        }
-
-                        if (nextMonth && nextDay) {
-                            row.dividend_date = `次回予想: ${nextYear}年${nextMonth}月${nextDay}日頃`;
-                        }
-                    }
+    // Coalesce table re-renders while prices stream in: at most one per RENDER_INTERVAL_MS
+    const RENDER_INTERVAL_MS = 500;
+    let renderTimer = null;
+
+    function scheduleRender() {
+        if (renderTimer !== null) return;
+        renderTimer = setTimeout(() => {
+            renderTimer = null;
+            renderTable(currentData);
+        }, RENDER_INTERVAL_MS);
+    }
+
+    function flushRender() {
+        if (renderTimer !== null) {
+            clearTimeout(renderTimer);
+            renderTimer = null;
+        }
+        renderTable(currentData);
+    }
+
+    async function fetchPriceBatch(batch, bDates) {
+        try {
+            const symbols = batch.map(row => `${row.clean_code}.T`.toUpperCase());
+            const res = await fetch(`/api/proxy/yfinance_batch?tickers=${encodeURIComponent(symbols.join(','))}`);
+            const json = await res.json();
+
+            if (json.status === 'success' && json.data) {
+                batch.forEach((row, i) => {
+                    const hist = json.data[symbols[i]];
+                    if (hist) applyHistory(row, hist, bDates);
+                });
+                scheduleRender();
+            }
+        } catch (err) {
+            console.error(`Error fetching prices for ${batch.map(row => row.code).join(', ')}:`, err);
+        }
+    }
+
+    function applyHistory(row, hist, bDates) {
+        // Trading days in ascending order, so lookups can binary-search instead of walking back day by day
+        const histDates = Object.keys(hist).sort();
+
+        const getPriceForDate = (targetD) => {
+            const targetStr = new Date(targetD).toISOString().split('T')[0];
+            const limit = new Date(targetD);
+            limit.setDate(limit.getDate() - 9); // Look back at most 10 days
+            const limitStr = limit.toISOString().split('T')[0];
+
+            // Find the last trading day on or before the target
+            let lo = 0;
+            let hi = histDates.length;
+            while (lo < hi) {
+                const mid = (lo + hi) >> 1;
+                if (histDates[mid] <= targetStr) lo = mid + 1;
+                else hi = mid;
+            }
+            if (lo === 0 || histDates[lo - 1] < limitStr) return null;
+            return hist[histDates[lo - 1]].Close;
+        };
 
-                    renderTable(currentData);
+        const currentPrice = getPriceForDate(bDates.target);
+        const prevPrice = getPriceForDate(bDates.prev);
+        const weekPrice = getPriceForDate(bDates.week);
+        const twoWeekPrice = getPriceForDate(bDates.two_weeks);
+        const yearPrice = getPriceForDate(bDates.year);
+
+        row.price = currentPrice ? Math.round(currentPrice * 100) / 100 : null;
+        row.change_1d_pct = formatPctChange(prevPrice, currentPrice);
+        row.change_1w_pct = formatPctChange(weekPrice, currentPrice);
+        row.change_2w_pct = formatPctChange(twoWeekPrice, currentPrice);
+        row.change_1y_pct = formatPctChange(yearPrice, currentPrice);
+
+        row.dividend_yield = "-";
+        row.dividend_date = "-";
+
+        let annualDiv = 0;
+        const oneYearAgoTime = new Date().getTime() - (365 * 24 * 60 * 60 * 1000);
+        // ISO date strings compare chronologically, so only dividend rows need a Date object
+        const oneYearAgoStr = new Date(oneYearAgoTime).toISOString().split('T')[0];
+        let hasDivs = false;
+        const divDates = [];
+
+        // histDates is ascending, so divDates comes out already sorted
+        histDates.forEach(dStr => {
+            const div = hist[dStr].Dividends;
+            if (div > 0) {
+                hasDivs = true;
+                divDates.push(new Date(dStr));
+                if (dStr > oneYearAgoStr) {
+                    annualDiv += div;
                 }
-            } catch (err) {
-                console.error(`Error fetching price for ${row.code}:`, err);
+            }
+        });
+
+        if (hasDivs && currentPrice && currentPrice > 0 && annualDiv > 0) {
+            const calcYield = (annualDiv / currentPrice) * 100;
+            row.dividend_yield = `${calcYield.toFixed(2)}%`;
+        }
+
+        if (hasDivs && divDates.length > 0) {
+            const recentDivs = divDates.slice(-24);
+            const today = new Date();
+
+            // Sum and count payout days per month in a single pass
+            const daySums = {};
+            const dayCounts = {};
+            recentDivs.forEach(d => {
+                const m = d.getMonth() + 1;
+                daySums[m] = (daySums[m] || 0) + d.getDate();
+                dayCounts[m] = (dayCounts[m] || 0) + 1;
+            });
+
+            const payoutMonths = Object.keys(dayCounts).map(Number).sort((a, b) => a - b);
+            const avgDayByMonth = {};
+            payoutMonths.forEach(m => {
+                avgDayByMonth[m] = Math.round(daySums[m] / dayCounts[m]);
+            });
+
+            // Next payout is the earliest (month, day) strictly after today, wrapping into next year.
+            // Encoding as month * 100 + day lets a single min() pick it.
+            const todayKey = (today.getMonth() + 1) * 100 + today.getDate();
+            const payoutKeys = payoutMonths.map(m => m * 100 + avgDayByMonth[m]);
+            const upcomingKeys = payoutKeys.filter(k => k > todayKey);
+            const nextKey = Math.min(...(upcomingKeys.length > 0 ? upcomingKeys : payoutKeys));
+            const nextYear = today.getFullYear() + (upcomingKeys.length > 0 ? 0 : 1);
+            const nextMonth = Math.floor(nextKey / 100);
+            const nextDay = nextKey % 100;
+
+            if (nextMonth && nextDay) {
+                row.dividend_date = `次回予想: ${nextYear}年${nextMonth}月${nextDay}日頃`;
             }
         }
     }